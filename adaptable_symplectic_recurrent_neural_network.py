@@ -3,6 +3,7 @@
 
 """
 
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import trange
@@ -10,6 +11,9 @@ import torch
 import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
+from torch.func import vmap, grad
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import TensorDataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 from mpl_toolkits import mplot3d
 
 from tqdm import tqdm
@@ -31,23 +35,51 @@ class adaptable_HNN(nn.Module):
       self.num_neurons = num_neurons #A list containing number of neurons per layer for hidden layers(should be of length num_hidden)
       self.n_params = n_params #no. of parameters
 
-      #defining a sequential model that takes in q, p and params and gives H(q, p; params)
-      self.input_model = nn.Sequential(nn.Linear(input_size+n_params, num_neurons[0]), nn.Tanh()) 
+      #defining a sequential model that takes in q, p and params and gives H(q, p; params). The first layer is split into a part acting on (q, p) and a
+      #bias free part acting on params, so the projection of the parameters (constant over a rollout) can be computed once outside the RNN loop
+      self.W_state = nn.Linear(input_size, num_neurons[0])
+      self.W_params = nn.Linear(n_params, num_neurons[0], bias=False)
+      #both parts are re-initialised with the default nn.Linear bound of the unsplit layer, whose fan in counts (q, p) and params together
+      bound = 1/np.sqrt(input_size+n_params)
+      for w in (self.W_state.weight, self.W_state.bias, self.W_params.weight):
+        nn.init.uniform_(w, -bound, bound)
+      self.linears = nn.ModuleList() #remaining hidden layers followed by the energy layer, applied by _mlp
       for i in range(num_hidden-1):
-        self.input_model.append(nn.Linear(num_neurons[i], num_neurons[i+1]))
-        self.input_model.append(nn.Tanh())
+        self.linears.append(nn.Linear(num_neurons[i], num_neurons[i+1]))
     
-      self.energy_layer = nn.Sequential(nn.Linear(num_neurons[-1], 1))
-
-
-    def forward(self, q, p, params, training=True):
-      self.input = torch.cat((q, p, params), dim=1)
-      sequential_output = self.input_model(self.input)
-      H = self.energy_layer(sequential_output)
-      if training==True: #defines whether the network is in training or predicting
-        dH_dq, dH_dp = torch.autograd.grad(H.sum(), (q, p), create_graph=True) #returns delH_delq, delH_delp and enforces Hamilton's equations by comparing them to -pdot and qdot
-      else:
-        dH_dq, dH_dp = torch.autograd.grad(H.sum(), (q, p))
+      self.linears.append(nn.Linear(num_neurons[-1], 1))
+
+
+    def _mlp(self, h): #takes the pre-activation of the first hidden layer
+      *hidden, energy_layer = self.linears #unpacked rather than sliced, as slicing a ModuleList builds a new module on every call
+      h = torch.tanh(h)
+      for lin in hidden:
+        h = torch.tanh(lin(h))
+      return energy_layer(h)
+
+    def energy(self, x, params_h): #H of a single input or a batch, returned both as the scalar that is differentiated and as the (..., 1) output
+      H = self._mlp(self.W_state(x) + params_h)
+      return H.sum(), H
+
+    def input_grad(self, x, params_h, training): #dH/dx and H for a batch x
+      if torch.compiler.is_compiling() or not torch.is_grad_enabled():
+        #per sample gradient vectorised over the batch, which traces into the compiled step and also runs without autograd (e.g. under inference_mode)
+        return vmap(grad(self.energy, has_aux=True))(x, params_h)
+      #in eager mode with autograd on, torch.autograd.grad has a much lower per call overhead than the torch.func wrappers
+      if not x.requires_grad: #a detached alias, so requires_grad is not set on the caller's tensor
+        x = x.detach().requires_grad_()
+      H_sum, H = self.energy(x, params_h)
+      dH_dx, = torch.autograd.grad(H_sum, x, create_graph=training)
+      return dH_dx, H
+
+    def forward(self, q, p, params, training=True, params_h=None):
+      if params_h is None: #params_h = W_params(params) may be precomputed by the caller, in which case params is not used
+        params_h = self.W_params(params)
+      x = torch.cat((q, p), dim=1) #kept local so the previous step's input is not held alive on the module
+      dH_dx, H = self.input_grad(x, params_h, training) #gradient of H w.r.t (q, p)
+      dH_dq, dH_dp = dH_dx[:, :q.shape[1]], dH_dx[:, q.shape[1]:] #returns delH_delq, delH_delp and enforces Hamilton's equations by comparing them to -pdot and qdot
+      if training==False: #defines whether the network is in training or predicting
+        dH_dq, dH_dp = dH_dq.detach(), dH_dp.detach()
 
       return H, -dH_dq, dH_dp
 
@@ -56,7 +88,7 @@ class adaptable_HNN(nn.Module):
 ##### and V = V(q; params). H = K(p) + V(q; params) ######
 
 class adaptable_partial_HNN(nn.Module): #Net for Kinetic Energy or Potential Energy, depending on the 'potential' flag
-  def __init__(self, input_size, num_hidden, num_neurons, n_params, potential=False):
+  def __init__(self, input_size, num_hidden, num_neurons, n_params, potential=False, trunk=None):
     super(adaptable_partial_HNN, self).__init__()
     self.input_size = input_size #half the dimensionality of the system(no. of position variables)
     self.num_hidden = num_hidden #No. of hidden layers in the HNN
@@ -64,117 +96,241 @@ class adaptable_partial_HNN(nn.Module): #Net for Kinetic Energy or Potential Ene
     self.n_params = n_params #no. of parameters (Considering separable hamiltonians it is assumed only the potential is a function of these parameters and K = K(q) only)
     self.potential = potential #potential flag
 
-    if self.potential: #defining a sequential model that takes in q and params and gives V(q; params)
-      self.input_model = nn.Sequential(nn.Linear(input_size+n_params, num_neurons[0]), nn.Tanh())
+    #defining a sequential model that takes in p and returns K(p), or that takes in q and params and gives V(q; params) with the first layer split as in adaptable_HNN
+    if trunk is None:
+      self.W_state = nn.Linear(input_size, num_neurons[0])
+      self.linears = nn.ModuleList() #remaining hidden layers followed by the energy layer, applied by _mlp
       for i in range(num_hidden-1):
-        self.input_model.append(nn.Linear(num_neurons[i], num_neurons[i+1]))
-        self.input_model.append(nn.Tanh())
-    
-      self.energy_layer = nn.Sequential(nn.Linear(num_neurons[-1], 1))
+        self.linears.append(nn.Linear(num_neurons[i], num_neurons[i+1]))
+    else: #reuses the first and hidden layers of another partial HNN of the same widths (the trunk), only the energy layer is its own
+      self.W_state = trunk.W_state
+      self.linears = nn.ModuleList(trunk.linears[:-1])
 
-    else: #defining a sequential model that takes in p and returns K(p)
-      self.input_model = nn.Sequential(nn.Linear(input_size, num_neurons[0]), nn.Tanh())
-      for i in range(num_hidden-1):
-        self.input_model.append(nn.Linear(num_neurons[i], num_neurons[i+1]))
-        self.input_model.append(nn.Tanh())
+    if self.potential:
+      self.W_params = nn.Linear(n_params, num_neurons[0], bias=False)
+      if trunk is None: #initialised as the unsplit first layer, as in adaptable_HNN
+        bound = 1/np.sqrt(input_size+n_params)
+        for w in (self.W_state.weight, self.W_state.bias, self.W_params.weight):
+          nn.init.uniform_(w, -bound, bound)
     
-      self.energy_layer = nn.Sequential(nn.Linear(num_neurons[-1], 1))
-
+    self.linears.append(nn.Linear(num_neurons[-1], 1))
+
+
+  def _mlp(self, h): #takes the pre-activation of the first hidden layer
+    *hidden, energy_layer = self.linears
+    h = torch.tanh(h)
+    for lin in hidden:
+      h = torch.tanh(lin(h))
+    return energy_layer(h)
+
+  def energy(self, x, params_h=None): #K or V of a single input or a batch, returned both as the scalar that is differentiated and as the (..., 1) output
+    h = self.W_state(x)
+    if params_h is not None:
+      h = h + params_h
+    E = self._mlp(h)
+    return E.sum(), E
+
+  def input_grad(self, x, params_h, training): #dE/dx and E for a batch x, choosing the gradient path as in adaptable_HNN
+    if torch.compiler.is_compiling() or not torch.is_grad_enabled():
+      if params_h is None:
+        return vmap(grad(self.energy, has_aux=True))(x)
+      return vmap(grad(self.energy, has_aux=True))(x, params_h)
+    if not x.requires_grad:
+      x = x.detach().requires_grad_()
+    E_sum, E = self.energy(x, params_h)
+    dE_dx, = torch.autograd.grad(E_sum, x, create_graph=training)
+    return dE_dx, E
+
+  def value(self, qp, params, params_h=None): #batched K(p) or V(q; params) alone, for when dH/dqp is not needed
+    h = self.W_state(qp)
+    if self.potential:
+      if params_h is None:
+        params_h = self.W_params(params)
+      h = h + params_h
+    return self._mlp(h)
 
-  def forward(self, qp, params, training=True):
+  def forward(self, qp, params, training=True, params_h=None):
     if self.potential:
-      self.input = torch.cat((qp, params), dim=1)
-      sequential_output = self.input_model(self.input)
-      V = self.energy_layer(sequential_output)
-      if training==True: #defines whether the network is in training or predicting
-        dH_dq = torch.autograd.grad(V.sum(), qp, create_graph=True) #gradient of V(q; params) w.r.t q ---> dp/dt
-        return V, -dH_dq[0]
-      else:
-        dH_dq = torch.autograd.grad(V.sum(), qp) 
-        return V, -dH_dq[0]
+      if params_h is None: #params_h = W_params(params) may be precomputed by the caller, in which case params is not used
+        params_h = self.W_params(params)
+      dH_dq, V = self.input_grad(qp, params_h, training) #gradient of V(q; params) w.r.t q ---> dp/dt
+      if training==False: #defines whether the network is in training or predicting
+        dH_dq = dH_dq.detach()
+      return V, -dH_dq
 
     else:
-      sequential_output = self.input_model(qp.clone())
-      K = self.energy_layer(sequential_output)
-      if training == True:
-        dH_dp = torch.autograd.grad(K.sum(), qp, create_graph=True) #gradient of K(p) w.r.t p ---> dq/dt
-        return K, dH_dp[0]
-      else:
-        dH_dp = torch.autograd.grad(K.sum(), qp)
-        return K, dH_dp[0]
+      dH_dp, K = self.input_grad(qp, None, training) #gradient of K(p) w.r.t p ---> dq/dt
+      if training==False:
+        dH_dp = dH_dp.detach()
+      return K, dH_dp
 
 ##### The below class creates a class modelled on the architecture proposed by Chen et al. but made adaptable by adding parameter channels in the manner proposed by Han et al. #####
 
 class adaptable_sympRNN(nn.Module):
 
-  def __init__(self, input_size, num_hidden, num_neurons, n_params, dt, separable=True):
+  def __init__(self, input_size, num_hidden, num_neurons, n_params, dt, separable=True, compiled=False, mixed_precision=False, checkpointing=False, shared_trunk=False):
     super(adaptable_sympRNN, self).__init__()
     self.input_size = input_size 
     self.num_hidden = num_hidden
     self.num_neurons = num_neurons
     self.n_params = n_params 
     self.separable = separable #flag that assumes separable Hamiltonian or not
+    self.compiled = compiled #flag that compiles the leapfrog steps with torch.compile (TorchInductor), the first calls then take minutes to compile
+    self.mixed_precision = mixed_precision #flag that runs the HNN MLPs in bfloat16 under torch.autocast, the integrator state stays in float32
+    self.shared_trunk = shared_trunk #flag that lets K_net and V_net share their hidden layers, with separate energy layers (separable case only)
+    self.checkpointing = checkpointing #flag that recomputes each step's MLP activations during backward instead of storing them, for long rollouts
     
     self.dt = dt #the time separation between subsequent steps of the Recurrent units
 
     if self.separable==True:
       self.K_net = adaptable_partial_HNN(int(self.input_size/2), self.num_hidden, self.num_neurons, self.n_params, potential=False)
-      self.V_net = adaptable_partial_HNN(int(self.input_size/2), self.num_hidden, self.num_neurons, self.n_params, potential=True)
+      self.V_net = adaptable_partial_HNN(int(self.input_size/2), self.num_hidden, self.num_neurons, self.n_params, potential=True,
+                                         trunk=self.K_net if self.shared_trunk else None)
     else:
       self.HNN = adaptable_HNN(self.input_size, self.num_hidden, self.num_neurons, self.n_params)
 
+    #bookkeeping for the compiled steps and rollouts (defined on the class, below step2), kept even when compiled is off so it can be switched on later
+    self._compiled_shapes = [] #(batch, dim) shapes the compiled code is specialised for, the first max_specialised distinct ones seen
+    self.max_specialised = 3 #e.g. the training batch, the last smaller training batch and the last smaller validation batch
+    self._eager_shapes = set() #shapes beyond max_specialised that have already been warned about
+    self.max_unroll = 50 #longest rollout that is unrolled, longer ones (e.g. predictions over thousands of steps) loop over the compiled step
+    self._unrolled_final = None #the one rollout length that is unrolled, fixed by the first call with final<=max_unroll
+
   def forward(self, q_initial, p_initial, params, final, training=True):
-    batch, dim = q_initial.shape
-    q, p = torch.zeros(final+1, batch, dim).to(device), torch.zeros(final+1, batch, dim).to(device)
-    H = torch.zeros(final, batch, 1).to(device)
-    q[0] = q_initial ; p[0] = p_initial
+    with torch.autocast(device_type=q_initial.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision):
+      #the parameters enter only through the first layer, so their projection is computed once per rollout instead of once per step
+      if self.separable==True:
+        params_h = self.V_net.W_params(params)
+      else:
+        params_h = self.HNN.W_params(params)
+      if self.compiled and not self.checkpointing and self._unrolls(final) and self._specialised(q_initial.shape):
+        if self.separable==True:
+          return self._compiled_rollout_sep(q_initial, p_initial, params_h, final, training)
+        else:
+          return self._compiled_rollout_nonsep(q_initial, p_initial, params_h, final, training)
+
+      if not torch.is_grad_enabled():
+        return self._buffered_rollout(q_initial, p_initial, params_h, final, training)
+
+      step = self._checkpointed_step if self.checkpointing else self._step
+      #H[-1], _, __ = self.HNN(q[-1], p[-1], params, training)
+      return self._rollout(step, q_initial, p_initial, params_h, final, training)
+
+  def _buffered_rollout(self, q_cur, p_cur, params_h, final, training): #rollouts without autograd (validation under inference_mode, predictions under no_grad)
+    #the outputs are written straight into buffers allocated once per rollout, instead of being kept per step and copied again by stack
+    dtype = q_cur.dtype
+    batch, dim = q_cur.shape
+    qs = torch.empty(final, batch, dim, dtype=dtype, device=q_cur.device)
+    ps = torch.empty(final, batch, dim, dtype=dtype, device=q_cur.device)
+    Hs = torch.empty(final, batch, 1, dtype=dtype, device=q_cur.device)
     for t in range(final):
+      H_t, q_cur, p_cur = self._step(q_cur, p_cur, params_h, training)
+      H_t, q_cur, p_cur = H_t.to(dtype), q_cur.to(dtype), p_cur.to(dtype)
+      qs[t] = q_cur ; ps[t] = p_cur ; Hs[t] = H_t
+    return Hs, qs, ps
+
+  def _rollout(self, step, q_cur, p_cur, params_h, final, training): #the RNN loop with autograd, run by forward and traced by the compiled rollouts
+    #outputs are collected per step and stacked once at the end, an in place write into a buffer would add an autograd node per step
+    dtype = q_cur.dtype
+    qs, ps, Hs = [], [], []
+    for t in range(final):
+      H_t, q_cur, p_cur = step(q_cur, p_cur, params_h, training)
+      H_t, q_cur, p_cur = H_t.to(dtype), q_cur.to(dtype), p_cur.to(dtype) #no-op without autocast, under it this stops bfloat16 rounding accumulating over the rollout
+      qs.append(q_cur) ; ps.append(p_cur) ; Hs.append(H_t)
+    return torch.stack(Hs), torch.stack(qs), torch.stack(ps)
+
+  def _rollout_sep(self, q, p, params_h, final, training):
+    return self._rollout(self.step, q, p, params_h, final, training)
+
+  def _rollout_nonsep(self, q, p, params_h, final, training):
+    return self._rollout(self.step2, q, p, params_h, final, training)
+
+  def _unrolls(self, final): #whether this rollout length is unrolled, each length is a separate graph so any other one loops over the compiled step
+    if self._unrolled_final is None and final<=self.max_unroll:
+      self._unrolled_final = final
+    return final==self._unrolled_final
+
+  def _specialised(self, shape): #whether the compiled code applies to this (batch, dim), further shapes are added until max_specialised is reached
+    if shape in self._compiled_shapes:
+      return True
+    if len(self._compiled_shapes)<self.max_specialised:
+      self._compiled_shapes.append(shape)
+      return True
+    if shape not in self._eager_shapes:
+      self._eager_shapes.add(shape)
+      warnings.warn(f"adaptable_sympRNN is compiled for the (batch, dim) shapes {[tuple(sh) for sh in self._compiled_shapes]}, "
+                    f"inputs of shape {tuple(shape)} run eagerly")
+    return False
+
+  def _step(self, q, p, params_h, training): #dispatches to the compiled step, or to the eager one for a (batch, dim) it was not specialised for
+    if self.compiled and self._specialised(q.shape):
       if self.separable==True:
-        H[t], q[t+1], p[t+1] = self.step(q[t], p[t], params, training)
+        return self._compiled_step_sep(q, p, params_h, training)
       else:
-        H[t], q[t+1], p[t+1] = self.step2(q[t], p[t], params, training)
+        return self._compiled_step_nonsep(q, p, params_h, training)
+    return self._eager_step(q, p, params_h, training)
+
+  def _checkpointed_step(self, q, p, params_h, training): #saved tensors then scale with a single step rather than with final
+    #the reentrant variant is used because torch.func.grad does not support the saved tensor hooks the non reentrant one relies on.
+    #It runs the step once without grad and again with grad during backward, and each grad mode would be another compiled variant of the
+    #step per shape, so checkpointed steps always run eagerly
+    return checkpoint(self._eager_step, q, p, params_h, training, use_reentrant=True)
 
-    #H[-1], _, __ = self.HNN(q[-1], p[-1], params, training)
-    return H, q[1:], p[1:]
+  @torch.compiler.disable
+  def _eager_step(self, q, p, params_h, training): #shapes beyond max_specialised (e.g. a single prediction after training) run eagerly instead of triggering a recompile
+    if self.separable==True:
+      return self.step(q, p, params_h, training)
+    else:
+      return self.step2(q, p, params_h, training)
 
-  def step(self, q, p, params, training):
+  def step(self, q, p, params_h, training):
     if training==True:
-      #implementation of leapfrog(symplectic algorithm)
-      K, qdot = self.K_net(p, params)
-      q_half = q + (self.dt)/2 * qdot
-      V, pdot_t = self.V_net(q_half, params)
-      p_next = p + self.dt * pdot_t
-      K, qdot_t = self.K_net(p_next, params)
-      q_next = q_half + (self.dt)/2 * qdot_t
-      V, pdot = self.V_net(q_next, params)
+      #implementation of leapfrog(symplectic algorithm), each update x + c*xdot is a single fused torch.add rather than a mul followed by an add
+      K, qdot = self.K_net(p, None)
+      q_half = torch.add(q, qdot, alpha=self.dt/2)
+      V, pdot_t = self.V_net(q_half, None, params_h=params_h)
+      p_next = torch.add(p, pdot_t, alpha=self.dt)
+      K, qdot_t = self.K_net(p_next, None)
+      q_next = torch.add(q_half, qdot_t, alpha=self.dt/2)
+      V = self.V_net.value(q_next, None, params_h=params_h) #only the energy is needed at q_next, so no gradient is taken
     else:
-      K, qdot = self.K_net(p, params, training=False)
-      q_half = q + (self.dt)/2 * qdot
-      V, pdot = self.V_net(q_half, params, training=False)
-      p_next = p + self.dt * pdot
-      K, qdot = self.K_net(p_next, params, training=False)
-      q_next = q_half + (self.dt)/2 * qdot
-      V, pdot = self.V_net(q_next, params, training=False)
+      K, qdot = self.K_net(p, None, training=False)
+      q_half = torch.add(q, qdot, alpha=self.dt/2)
+      V, pdot = self.V_net(q_half, None, training=False, params_h=params_h)
+      p_next = torch.add(p, pdot, alpha=self.dt)
+      K, qdot = self.K_net(p_next, None, training=False)
+      q_next = torch.add(q_half, qdot, alpha=self.dt/2)
+      V = self.V_net.value(q_next, None, params_h=params_h)
  
     return K+V, q_next, p_next
 
-  def step2(self, q, p, params, training):
+  def step2(self, q, p, params_h, training):
     if training==True:
-      H, pdot, qdot = self.HNN(q, p, params)
-      q_half = q + (self.dt)/2 * qdot
-      _, pdot_t, qdot_t = self.HNN(q_half, p, params)
-      p_next = p + self.dt * pdot_t
-      _, pdot_half, qdot_t = self.HNN(q_half, p_next, params)
-      q_next = q_half + (self.dt)/2 * qdot_t
+      H, pdot, qdot = self.HNN(q, p, None, params_h=params_h)
+      q_half = torch.add(q, qdot, alpha=self.dt/2)
+      _, pdot_t, qdot_t = self.HNN(q_half, p, None, params_h=params_h)
+      p_next = torch.add(p, pdot_t, alpha=self.dt)
+      _, pdot_half, qdot_t = self.HNN(q_half, p_next, None, params_h=params_h)
+      q_next = torch.add(q_half, qdot_t, alpha=self.dt/2)
     else:
-      H, pdot, qdot = self.HNN(q, p, params, training=False)
-      q_half = q + (self.dt)/2 * qdot
-      _, pdot_t, qdot_t = self.HNN(q_half, p, params, training=False)
-      p_next = p + self.dt * pdot_t
-      _, pdot_half, qdot_t = self.HNN(q_half, p_next, params, training=False)
-      q_next = q_half + (self.dt)/2 * qdot_t
+      H, pdot, qdot = self.HNN(q, p, None, training=False, params_h=params_h)
+      q_half = torch.add(q, qdot, alpha=self.dt/2)
+      _, pdot_t, qdot_t = self.HNN(q_half, p, None, training=False, params_h=params_h)
+      p_next = torch.add(p, pdot_t, alpha=self.dt)
+      _, pdot_half, qdot_t = self.HNN(q_half, p_next, None, training=False, params_h=params_h)
+      q_next = torch.add(q_half, qdot_t, alpha=self.dt/2)
  
     return H, q_next, p_next
+
+  #the compiled steps and rollouts are built once on the class from the plain functions and called with the module as self. Closures over a bound
+  #self stored on the instance would make copy.deepcopy share the original's networks and break pickling
+  #the step fuses the pointwise leapfrog updates and the small MLP evaluations into fewer kernels, specialised to fixed batch and dim
+  _compiled_step_sep = torch.compile(step, dynamic=False, fullgraph=False)
+  _compiled_step_nonsep = torch.compile(step2, dynamic=False, fullgraph=False)
+  #for the training horizon the whole RNN loop is compiled as one graph, final is a compile time constant so Inductor unrolls it across all timesteps
+  #fullgraph is left off so that reaching the recompile limit, which is shared by every instance, falls back to eager instead of raising
+  _compiled_rollout_sep = torch.compile(_rollout_sep, dynamic=False, fullgraph=False)
+  _compiled_rollout_nonsep = torch.compile(_rollout_nonsep, dynamic=False, fullgraph=False)
   
 
   def call_V(self, q, params):
@@ -186,6 +342,16 @@ class adaptable_sympRNN(nn.Module):
   def call_HNN(self, q, p, params):
     return self.HNN(q, p, params, training=False)
 
+#the below function wraps initial conditions, parameters and target trajectories in a DataLoader yielding batches of size batch_size
+def batch_loader(q_input, p_input, params, q_output, p_output, batch_size, shuffle=True):
+  #the outputs are stored as (time, batch, dim), so they are permuted to put the batch dimension first as TensorDataset indexes along dim 0
+  dataset = TensorDataset(*(x.detach() for x in (q_input, p_input, params, q_output.permute(1, 0, 2), p_output.permute(1, 0, 2))))
+  sampler = BatchSampler(RandomSampler(dataset) if shuffle else SequentialSampler(dataset), batch_size, drop_last=False)
+  on_host = not q_input.is_cuda #worker processes and pinning only apply to data held on the host
+  #batch_size=None with a BatchSampler indexes each tensor once per batch instead of collating batch_size single samples
+  return DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=2 if on_host else 0,
+                    pin_memory=on_host and device.type=='cuda', persistent_workers=on_host)
+
 #the below function takes in a adaptive symplectic recurrent neural network and performs simultaneous training and validation
 def train_validate(model, q_input_train, p_input_train, params_train, q_output_train, p_output_train,
                               q_input_valid, p_input_valid, params_valid, q_output_valid, p_output_valid, 
@@ -194,8 +360,12 @@ def train_validate(model, q_input_train, p_input_train, params_train, q_output_t
   optimizer = optim.Adam(model.parameters(), lr=learning_rate)
   criterion = nn.MSELoss() #Mean Square error loss
 
-  num_train = int(q_input_train.shape[0]/batch_size)
-  num_valid = int(q_input_valid.shape[0]/batch_size)
+  #host data is pinned by the loaders so that the per batch copies to the GPU are asynchronous
+  train_loader = batch_loader(q_input_train, p_input_train, params_train, q_output_train, p_output_train, batch_size, shuffle=True)
+  valid_loader = batch_loader(q_input_valid, p_input_valid, params_valid, q_output_valid, p_output_valid, batch_size, shuffle=False)
+
+  num_train = len(train_loader) #number of batches, the last one may be smaller than batch_size
+  num_valid = len(valid_loader)
 
   time = q_output_train.shape[0] #how far in time to predict
 
@@ -208,48 +378,45 @@ def train_validate(model, q_input_train, p_input_train, params_train, q_output_t
 
       train_batch_loss = 0
       model.train() #putting model in training mode
-      for b in range(num_train):
-        #we take slices of the data of size batch_size
-        q_input_train_batch = q_input_train[b:b+batch_size, :] 
-        p_input_train_batch = p_input_train[b:b+batch_size, :]
-        q_output_train_batch = q_output_train[:, b:b+batch_size, :]
-        p_output_train_batch = p_output_train[:, b:b+batch_size, :]
+      for q_input_train_batch, p_input_train_batch, params_train_batch, q_output_train_batch, p_output_train_batch in train_loader:
+        #we take batches of the data of size batch_size, with the outputs permuted back to (time, batch, dim)
+        q_input_train_batch = q_input_train_batch.to(device, non_blocking=True)
+        p_input_train_batch = p_input_train_batch.to(device, non_blocking=True)
+        q_output_train_batch = q_output_train_batch.to(device, non_blocking=True).transpose(0, 1)
+        p_output_train_batch = p_output_train_batch.to(device, non_blocking=True).transpose(0, 1)
 
-        params_train_batch = params_train[b:b+batch_size, :]
+        params_train_batch = params_train_batch.to(device, non_blocking=True)
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True) #drops the old gradients instead of filling them with zeros
         _, q, p = model(q_input_train_batch, p_input_train_batch, params_train_batch, time) #calling model
         
-        train_loss = criterion(torch.cat((q, p), dim=2),
-                               torch.cat((q_output_train_batch, p_output_train_batch), dim=2))
+        #MSE over the concatenation of q and p, written as the mean of the two MSEs (q and p have the same shape) to avoid building the concatenated tensors
+        train_loss = 0.5 * (criterion(q, q_output_train_batch) + criterion(p, p_output_train_batch))
         
-        train_batch_loss += train_loss.item()
+        train_batch_loss += train_loss.detach() #accumulated on the device, a .item() per batch would synchronise and stall the queued copies
         train_loss.backward()
         optimizer.step()
 
-      train_batch_loss /= num_train
-      training_loss[it] = train_batch_loss
+      training_loss[it] = float(train_batch_loss)/num_train
 
       #validate
       valid_batch_loss = 0
       model.eval()
-      for b in range(num_valid):
-        q_input_valid_batch = q_input_valid[b:b+batch_size, :]
-        p_input_valid_batch = p_input_valid[b:b+batch_size, :]
-        q_output_valid_batch = q_output_valid[:, b:b+batch_size, :]
-        p_output_valid_batch = p_output_valid[:, b:b+batch_size, :]
+      with torch.inference_mode(): #no backward pass is made on the validation loss, so no tensors are saved for autograd
+        for q_input_valid_batch, p_input_valid_batch, params_valid_batch, q_output_valid_batch, p_output_valid_batch in valid_loader:
+          q_input_valid_batch = q_input_valid_batch.to(device, non_blocking=True)
+          p_input_valid_batch = p_input_valid_batch.to(device, non_blocking=True)
+          q_output_valid_batch = q_output_valid_batch.to(device, non_blocking=True).transpose(0, 1)
+          p_output_valid_batch = p_output_valid_batch.to(device, non_blocking=True).transpose(0, 1)
 
-        params_valid_batch = params_valid[b:b+batch_size, :]
+          params_valid_batch = params_valid_batch.to(device, non_blocking=True)
 
-        optimizer.zero_grad()
-        _, q, p = model(q_input_valid_batch, p_input_valid_batch, params_valid_batch, time)
-        #pdot, qdot = calc_grad(H, qtrain_batch, ptrain_batch)
-        valid_loss = criterion(torch.cat((q, p), dim=2),
-                               torch.cat((q_output_valid_batch, p_output_valid_batch), dim=2))
+          _, q, p = model(q_input_valid_batch, p_input_valid_batch, params_valid_batch, time, training=False)
+          #pdot, qdot = calc_grad(H, qtrain_batch, ptrain_batch)
+          valid_loss = 0.5 * (criterion(q, q_output_valid_batch) + criterion(p, p_output_valid_batch))
 
-        valid_batch_loss += valid_loss.item()
+          valid_batch_loss += valid_loss
 
-      valid_batch_loss /= num_valid
-      validation_loss[it] = valid_batch_loss
+      validation_loss[it] = float(valid_batch_loss)/num_valid
 
   return training_loss, validation_loss